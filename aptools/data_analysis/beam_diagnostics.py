@@ -2,14 +2,329 @@
 
 import scipy.constants as ct
 import numpy as np
+from numba import njit, prange
 
 from aptools.helper_functions import (weighted_std, create_beam_slices,
+                                      weighted_average_of_product,
+                                      slope_of_correlation,
                                       remove_correlation,
                                       calculate_slice_average)
 
 
+# Compilation options shared by all Numba kernels in this module. The compiled
+# kernels are cached on disk so that the JIT compilation overhead is only paid
+# the first time they are used, not in every new Python session. The kernels
+# taking particle weights accept w=None for equally weighted particles, which
+# Numba compiles into a separate version without the weight loads.
+_jit_kernel = njit(parallel=True, fastmath=True, cache=True,
+                   error_model='numpy')
+
+
+@_jit_kernel
+def _compute_gamma(px, py, pz):
+    """Calculate the Lorentz factor of each particle from its momentum in
+    non-dimmensional units (beta*gamma)"""
+    n = px.shape[0]
+    gamma = np.empty(n)
+    for i in prange(n):
+        gamma[i] = np.sqrt(1 + px[i]*px[i] + py[i]*py[i] + pz[i]*pz[i])
+    return gamma
+
+
+def _as_contig(a, dtype=None):
+    """Return the particle data as a C-contiguous array, so that the Numba
+    kernels can use packed (SIMD) loads.
+
+    If dtype is None, floating-point arrays keep their precision and any
+    other input (lists, integer arrays, pandas Series...) is converted to
+    np.float64. None and single values are returned unchanged.
+    """
+    if a is None or np.ndim(a) == 0:
+        return a
+    a = np.asarray(a)
+    if dtype is None:
+        dtype = a.dtype if a.dtype in (np.float32, np.float64) else np.float64
+    return np.ascontiguousarray(a, dtype=dtype)
+
+
+def _check_lengths(*arrays):
+    """Raise a ValueError if the given particle arrays do not all have the
+    same length. None and single values are not checked."""
+    lengths = [len(a) for a in arrays if np.ndim(a) > 0]
+    if any(n != lengths[0] for n in lengths[1:]):
+        raise ValueError(
+            "All particle arrays must have the same length, got lengths "
+            "{}.".format(lengths))
+
+
+def _as_weights(w):
+    """Return the statistical weights of the particles as a C-contiguous
+    array, or None if all particles are equally weighted (w is None or a
+    single value).
+
+    The statistical weight of a particle is the absolute value of w, so that
+    the charge of the particles can be directly used as weight.
+    """
+    if np.ndim(w) == 0:
+        return None
+    return np.abs(_as_contig(w))
+
+
+def _slice_indices(z, slice_lims):
+    """Determine the slice to which each particle belongs.
+
+    A particle belongs to slice i if slice_lims[i] < z <= slice_lims[i+1].
+    Returns an array with the slice index of the particles which are inside
+    the slice limits, and the boolean mask selecting these particles.
+    """
+    n_slices = len(slice_lims) - 1
+    slice_idx = np.digitize(z, slice_lims, right=True) - 1
+    in_slices = (slice_idx >= 0) & (slice_idx < n_slices)
+    return slice_idx[in_slices], in_slices
+
+
+def _sorted_slices(z, slice_lims, *arrays):
+    """Sort the given particle arrays along z so that the particles of each
+    slice (slice_lims[i] < z <= slice_lims[i+1]) form a contiguous range.
+
+    Returns an array with the index of the first particle of each slice (and
+    the end of the last one) and a list with the sorted arrays. Single values
+    (or None) are returned unchanged.
+    """
+    order = np.argsort(z)
+    slice_edges = np.searchsorted(z[order], slice_lims, side='right')
+    sorted_arrays = [a[order] if np.ndim(a) > 0 else a for a in arrays]
+    return slice_edges, sorted_arrays
+
+
+def _slice_means(slice_idx, n_slices, w, slice_weight, values):
+    """Calculate the weighted mean of the values of the particles in each
+    slice, given the sum of the weights of each slice. The mean of the empty
+    slices is 0."""
+    return np.divide(_slice_sums(slice_idx, n_slices, w, values),
+                     slice_weight, out=np.zeros(n_slices),
+                     where=slice_weight > 0)
+
+
+def _slice_weights(w, in_slices=None):
+    """Return the particle weights used by the slice diagnostics.
+
+    Unlike in the other diagnostics, a single-valued w is kept instead of
+    being replaced by None, since it scales the statistical weight of each
+    slice. If the mask of the particles inside the slices is given, only
+    their weights are returned and w=None is replaced by a weight of 1.
+    """
+    if np.ndim(w) == 0:
+        if w is None:
+            return None if in_slices is None else 1.
+        return np.abs(np.float64(w))
+    w = _as_weights(w)
+    if in_slices is not None:
+        w = w[in_slices]
+    return w
+
+
+def _slice_sums(slice_idx, n_slices, w, values=None):
+    """Calculate the sum of the weighted values (or of the weights, if no
+    values are given) of the particles in each slice. A single-valued w is
+    applied to the slice sums instead of to every particle."""
+    if np.ndim(w) == 0:
+        return np.float64(w) * np.bincount(slice_idx, weights=values,
+                                           minlength=n_slices)
+    if values is not None:
+        w = w * values
+    return np.bincount(slice_idx, weights=w, minlength=n_slices)
+
+
+@_jit_kernel
+def _weighted_energy_stats(px, py, pz, w):
+    """Calculate the weighted mean and standard deviation of the particle
+    energy in a single pass over the momentum arrays. The calculation is
+    carried out in double precision regardless of the input type."""
+    n = px.shape[0]
+    if n == 0:
+        return np.nan, np.nan
+    # Accumulate the moments relative to the energy of the first particle to
+    # avoid cancellation errors when the spread is small compared to the mean.
+    g_0 = np.sqrt(1 + np.float64(px[0])**2 + np.float64(py[0])**2
+                  + np.float64(pz[0])**2)
+    sw = 0.
+    swg = 0.
+    swg2 = 0.
+    for i in prange(n):
+        px_i = np.float64(px[i])
+        py_i = np.float64(py[i])
+        pz_i = np.float64(pz[i])
+        dg = np.sqrt(1 + px_i*px_i + py_i*py_i + pz_i*pz_i) - g_0
+        if w is None:
+            w_i = 1.
+        else:
+            w_i = np.float64(w[i])
+        sw += w_i
+        swg += w_i*dg
+        swg2 += w_i*dg*dg
+    dg_avg = swg/sw
+    ene_std = np.sqrt(max(swg2/sw - dg_avg*dg_avg, 0.))
+    return g_0 + dg_avg, ene_std
+
+
+@_jit_kernel
+def _weighted_cov_2d(x, y, w):
+    """Calculate the weighted (co)variances of two variables in a single pass.
+
+    Returns the biased estimates of var(x), cov(x, y) and var(y), and the
+    factor which converts them into the unbiased estimates given by np.cov.
+    The moments are accumulated in double precision regardless of the input
+    type.
+    """
+    n = x.shape[0]
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    # Accumulate the moments relative to the first particle to avoid
+    # cancellation errors when the beam is far from the axis.
+    x_0 = np.float64(x[0])
+    y_0 = np.float64(y[0])
+    sw = 0.
+    sw2 = 0.
+    sx = 0.
+    sy = 0.
+    sxx = 0.
+    sxy = 0.
+    syy = 0.
+    for i in prange(n):
+        dx = np.float64(x[i]) - x_0
+        dy = np.float64(y[i]) - y_0
+        if w is None:
+            w_i = 1.
+        else:
+            w_i = np.float64(w[i])
+        sw += w_i
+        sw2 += w_i*w_i
+        sx += w_i*dx
+        sy += w_i*dy
+        sxx += w_i*dx*dx
+        sxy += w_i*dx*dy
+        syy += w_i*dy*dy
+    x_avg = sx/sw
+    y_avg = sy/sw
+    cov_xx = sxx/sw - x_avg*x_avg
+    cov_xy = sxy/sw - x_avg*y_avg
+    cov_yy = syy/sw - y_avg*y_avg
+    cov_norm = sw*sw/(sw*sw - sw2)
+    return cov_xx, cov_xy, cov_yy, cov_norm
+
+
+@_jit_kernel
+def _phase_space_moments(x, px, py, pz, w):
+    """Calculate the weighted (co)variances of x and px, as well as the
+    weighted mean Lorentz factor, in a single pass.
+
+    Returns the biased estimates of var(x), cov(x, px) and var(px), the
+    factor which converts them into the unbiased estimates given by np.cov
+    and the mean Lorentz factor. The moments are accumulated in double
+    precision regardless of the input type.
+    """
+    n = x.shape[0]
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan, np.nan
+    # Accumulate the moments relative to the first particle to avoid
+    # cancellation errors.
+    x_0 = np.float64(x[0])
+    px_0 = np.float64(px[0])
+    sw = 0.
+    sw2 = 0.
+    sx = 0.
+    spx = 0.
+    sxx = 0.
+    sxpx = 0.
+    spxpx = 0.
+    swg = 0.
+    for i in prange(n):
+        px_i = np.float64(px[i])
+        py_i = np.float64(py[i])
+        pz_i = np.float64(pz[i])
+        dx = np.float64(x[i]) - x_0
+        dpx = px_i - px_0
+        if w is None:
+            w_i = 1.
+        else:
+            w_i = np.float64(w[i])
+        sw += w_i
+        sw2 += w_i*w_i
+        sx += w_i*dx
+        spx += w_i*dpx
+        sxx += w_i*dx*dx
+        sxpx += w_i*dx*dpx
+        spxpx += w_i*dpx*dpx
+        swg += w_i*np.sqrt(1 + px_i*px_i + py_i*py_i + pz_i*pz_i)
+    x_avg = sx/sw
+    px_avg = spx/sw
+    cov_xx = sxx/sw - x_avg*x_avg
+    cov_xpx = sxpx/sw - x_avg*px_avg
+    cov_pxpx = spxpx/sw - px_avg*px_avg
+    cov_norm = sw*sw/(sw*sw - sw2)
+    return cov_xx, cov_xpx, cov_pxpx, cov_norm, swg/sw
+
+
+@_jit_kernel
+def _trace_space_moments(x, px, pz, w):
+    """Calculate the weighted (co)variances of x and x' = px/pz in a single
+    pass, without creating the x' array.
+
+    Returns the same quantities as _weighted_cov_2d(x, px/pz, w).
+    """
+    n = x.shape[0]
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    # Accumulate the moments relative to the first particle to avoid
+    # cancellation errors.
+    x_0 = np.float64(x[0])
+    xp_0 = np.float64(px[0]) / np.float64(pz[0])
+    sw = 0.
+    sw2 = 0.
+    sx = 0.
+    sxp = 0.
+    sxx = 0.
+    sxxp = 0.
+    sxpxp = 0.
+    for i in prange(n):
+        dx = np.float64(x[i]) - x_0
+        dxp = np.float64(px[i]) / np.float64(pz[i]) - xp_0
+        if w is None:
+            w_i = 1.
+        else:
+            w_i = np.float64(w[i])
+        sw += w_i
+        sw2 += w_i*w_i
+        sx += w_i*dx
+        sxp += w_i*dxp
+        sxx += w_i*dx*dx
+        sxxp += w_i*dx*dxp
+        sxpxp += w_i*dxp*dxp
+    x_avg = sx/sw
+    xp_avg = sxp/sw
+    cov_xx = sxx/sw - x_avg*x_avg
+    cov_xxp = sxxp/sw - x_avg*xp_avg
+    cov_xpxp = sxpxp/sw - xp_avg*xp_avg
+    cov_norm = sw*sw/(sw*sw - sw2)
+    return cov_xx, cov_xxp, cov_xpxp, cov_norm
+
+
+def _emittance_from_moments(cov_xx, cov_xy, cov_yy, cov_norm):
+    """Calculate the RMS emittance from the output of the moment kernels,
+    i.e., the square root of the determinant of the (unbiased) covariance
+    matrix"""
+    return np.sqrt(max(cov_xx*cov_yy - cov_xy**2, 0.)) * cov_norm
+
+
+def _weighted_emittance_2d(x, y, w):
+    """Calculate the RMS emittance of the particle distribution in the x-y
+    plane"""
+    return _emittance_from_moments(*_weighted_cov_2d(x, y, _as_weights(w)))
+
+
 def twiss_parameters(x, px, pz, py=None, w=None, emitt='tr',
-                     disp_corrected=False, corr_order=1):
+                     disp_corrected=False, corr_order=1, gamma=None):
     """Calculate the alpha and beta functions of the beam in a certain
     transverse plane
 
@@ -46,45 +361,57 @@ def twiss_parameters(x, px, pz, py=None, w=None, emitt='tr',
     corr_order : int
         Highest order up to which dispersion effects should be corrected.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A tuple with the value of the alpha, beta [m] and gamma [m^-1] functions
     """
+    x, px, pz, py, gamma = (_as_contig(a) for a in (x, px, pz, py, gamma))
+    w = _as_weights(w)
+    _check_lengths(x, px, pz, py, w, gamma)
     if emitt == 'ph':
-        em_x = normalized_transverse_rms_emittance(x, px, py, pz, w,
-                                                   disp_corrected, corr_order)
-        gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-        gamma_avg = np.average(gamma, weights=w)
-        x_avg = np.average(x, weights=w)
-        px_avg = np.average(px, weights=w)
-        # center x and x
-        x = x - x_avg
-        px = px - px_avg
-        if disp_corrected:
-            # remove x-gamma correlation
-            dgamma = (gamma - gamma_avg)/gamma_avg
-            x = remove_correlation(dgamma, x, w, corr_order)
-        b_x = np.average(x**2, weights=w)*gamma_avg/em_x
-        a_x = -np.average(x*px, weights=w)/em_x
+        # the emittance and the Twiss parameters follow from the same
+        # centered moments, which are computed in a single pass
+        if gamma is None and not disp_corrected:
+            # the mean energy is obtained in the same pass
+            cov_xx, cov_xpx, cov_pxpx, cov_norm, gamma_avg = (
+                _phase_space_moments(x, px, py, pz, w))
+        else:
+            if gamma is None:
+                gamma = _compute_gamma(px, py, pz)
+            gamma_avg = mean_energy(px, py, pz, w, gamma=gamma)
+            if disp_corrected:
+                # remove x-gamma correlation
+                dgamma = (gamma - gamma_avg)/gamma_avg
+                x = remove_correlation(dgamma, x, w, corr_order)
+            cov_xx, cov_xpx, cov_pxpx, cov_norm = _weighted_cov_2d(x, px, w)
+        em_x = _emittance_from_moments(cov_xx, cov_xpx, cov_pxpx, cov_norm)
+        b_x = cov_xx*gamma_avg/em_x
+        a_x = -cov_xpx/em_x
     elif emitt == 'tr':
-        em_x = transverse_trace_space_rms_emittance(x, px, py, pz, w,
-                                                    disp_corrected, corr_order)
-        xp = px/pz
-        # center x and xp
-        x_avg = np.average(x, weights=w)
-        xp_avg = np.average(xp, weights=w)
-        x = x - x_avg
-        xp = xp - xp_avg
+        # the emittance and the Twiss parameters follow from the same
+        # centered moments, which are computed in a single pass
         if disp_corrected:
+            xp = px/pz
             # remove x-gamma correlation
-            gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+            if gamma is None:
+                gamma = _compute_gamma(px, py, pz)
             gamma_avg = np.average(gamma, weights=w)
             dgamma = (gamma - gamma_avg)/gamma_avg
             x = remove_correlation(dgamma, x, w, corr_order)
             # remove xp-gamma correlation
             xp = remove_correlation(dgamma, xp, w, corr_order)
-        b_x = np.average(x**2, weights=w)/em_x
-        a_x = -np.average(x*xp, weights=w)/em_x
+            cov_xx, cov_xxp, cov_xpxp, cov_norm = _weighted_cov_2d(x, xp, w)
+        else:
+            # xp = px/pz is evaluated on the fly
+            cov_xx, cov_xxp, cov_xpxp, cov_norm = _trace_space_moments(
+                x, px, pz, w)
+        em_x = _emittance_from_moments(cov_xx, cov_xxp, cov_xpxp, cov_norm)
+        b_x = cov_xx/em_x
+        a_x = -cov_xxp/em_x
     g_x = (1 + a_x**2)/b_x
     return (a_x, b_x, g_x)
 
@@ -121,12 +448,14 @@ def dispersion(x, px, py, pz, gamma_ref=None, w=None):
     -------
     A float with the value of the dispersion in m.
     """
-    gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+    x, px, py, pz = (_as_contig(a) for a in (x, px, py, pz))
+    w = _as_weights(w)
+    _check_lengths(x, px, py, pz, w)
+    gamma = _compute_gamma(px, py, pz)
     if gamma_ref is None:
         gamma_ref = np.average(gamma, weights=w)
     dgamma = (gamma - gamma_ref)/gamma_ref
-    fit_coefs = np.polyfit(dgamma, x, 1, w=w)
-    disp = fit_coefs[0]
+    disp = slope_of_correlation(x, dgamma, w)
     return disp
 
 
@@ -146,6 +475,9 @@ def rms_length(z, w=None):
     -------
     A float with the RMS length value in meters.
     """
+    z = _as_contig(z)
+    w = _as_weights(w)
+    _check_lengths(z, w)
     s_z = weighted_std(z, weights=w)
     return s_z
 
@@ -166,6 +498,9 @@ def rms_size(x, w=None):
     -------
     A float with the RMS length value in meters.
     """
+    x = _as_contig(x)
+    w = _as_weights(w)
+    _check_lengths(x, w)
     s_x = weighted_std(x, weights=w)
     return s_x
 
@@ -195,11 +530,13 @@ def mean_kinetic_energy(px, py, pz, w=None):
     A float with the mean kinetic energy in non-dimmensional
     units, i.e. [1/(m_e c**2)]
     """
-    return np.average(np.sqrt(np.square(px) + np.square(py) + np.square(pz)),
-                      weights=w)
+    px, py, pz = (_as_contig(a) for a in (px, py, pz))
+    w = _as_weights(w)
+    _check_lengths(px, py, pz, w)
+    return np.average(np.sqrt(px*px + py*py + pz*pz), weights=w)
 
 
-def mean_energy(px, py, pz, w=None):
+def mean_energy(px, py, pz, w=None, gamma=None):
     """Calculate the mean energy of the provided particle distribution
 
     Parameters
@@ -219,14 +556,24 @@ def mean_energy(px, py, pz, w=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the mean energy in non-dimmensional units, i.e. [1/(m_e c**2)]
     """
-    return np.average(np.sqrt(1 + px**2 + py**2 + pz**2), weights=w)
+    px, py, pz, gamma = (_as_contig(a) for a in (px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(px, py, pz, w, gamma)
+    if gamma is None:
+        mean_ene, _ = _weighted_energy_stats(px, py, pz, w)
+        return mean_ene
+    return np.average(gamma, weights=w)
 
 
-def rms_energy_spread(px, py, pz, w=None):
+def rms_energy_spread(px, py, pz, w=None, gamma=None):
     """Calculate the absotule RMS energy spread of the provided particle
     distribution
 
@@ -247,17 +594,27 @@ def rms_energy_spread(px, py, pz, w=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the energy spread value in non-dimmensional units,
     i.e. [1/(m_e c**2)]
     """
-    part_ene = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-    ene_std = weighted_std(part_ene, weights=w)
+    px, py, pz, gamma = (_as_contig(a) for a in (px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(px, py, pz, w, gamma)
+    if gamma is None:
+        _, ene_std = _weighted_energy_stats(px, py, pz, w)
+        return ene_std
+    ene_std = weighted_std(gamma, weights=w)
     return ene_std
 
 
-def fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10, len_slice=None):
+def fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10, len_slice=None,
+                       gamma=None):
     """Calculate the absolute FWHM energy spread of the provided particle
     distribution
 
@@ -278,14 +635,22 @@ def fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10, len_slice=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the energy spread value in non-dimmensional units,
     i.e. [1/(m_e c**2)]
     """
-    part_ene = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+    z, px, py, pz, gamma = (_as_contig(a) for a in (z, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w, gamma)
+    if gamma is None:
+        gamma = _compute_gamma(px, py, pz)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
-    gamma_hist, z_edges = np.histogram(part_ene, bins=n_slices, weights=w)
+    gamma_hist, z_edges = np.histogram(gamma, bins=n_slices, weights=w)
     slice_pos = z_edges[1:] - abs(z_edges[1]-z_edges[0])/2
     peak = max(gamma_hist)
     slices_in_fwhm = slice_pos[np.where(gamma_hist >= peak/2)]
@@ -294,7 +659,7 @@ def fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10, len_slice=None):
 
 
 def relative_fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10,
-                                len_slice=None):
+                                len_slice=None, gamma=None):
     """Calculate the relative RMS energy spread of the provided particle
     distribution
 
@@ -315,18 +680,28 @@ def relative_fwhm_energy_spread(z, px, py, pz, w=None, n_slices=10,
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the relative energy spread value.
     """
+    z, px, py, pz, gamma = (_as_contig(a) for a in (z, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w, gamma)
+    # the histogram needs the energy of each particle, reuse it for the mean
+    if gamma is None:
+        gamma = _compute_gamma(px, py, pz)
     abs_spread = fwhm_energy_spread(z, px, py, pz, w=w, n_slices=n_slices,
-                                    len_slice=len_slice)
-    mean_ene = mean_energy(px, py, pz, w)
+                                    len_slice=len_slice, gamma=gamma)
+    mean_ene = mean_energy(px, py, pz, w, gamma=gamma)
     rel_spread = abs_spread/mean_ene
     return rel_spread
 
 
-def relative_rms_energy_spread(px, py, pz, w=None):
+def relative_rms_energy_spread(px, py, pz, w=None, gamma=None):
     """Calculate the relative RMS energy spread of the provided particle
     distribution
 
@@ -347,17 +722,28 @@ def relative_rms_energy_spread(px, py, pz, w=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the relative energy spread value.
     """
-    abs_spread = rms_energy_spread(px, py, pz, w)
-    mean_ene = mean_energy(px, py, pz, w)
+    px, py, pz, gamma = (_as_contig(a) for a in (px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(px, py, pz, w, gamma)
+    if gamma is None:
+        mean_ene, abs_spread = _weighted_energy_stats(px, py, pz, w)
+        return abs_spread/mean_ene
+    mean_ene = np.average(gamma, weights=w)
+    d_ene = gamma - mean_ene
+    abs_spread = np.sqrt(weighted_average_of_product(d_ene, d_ene, w))
     rel_spread = abs_spread/mean_ene
     return rel_spread
 
 
-def longitudinal_energy_chirp(z, px, py, pz, w=None):
+def longitudinal_energy_chirp(z, px, py, pz, w=None, gamma=None):
     """Calculate the longitudinal energy chirp, K, of the provided particle
     distribution in units of m**(-1). It is defined as dE/<E> = K*dz.
 
@@ -381,21 +767,29 @@ def longitudinal_energy_chirp(z, px, py, pz, w=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the chirp value in units of m^(-1)
     """
-    ene = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-    mean_ene = np.average(ene, weights=w)
+    z, px, py, pz, gamma = (_as_contig(a) for a in (z, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w, gamma)
+    if gamma is None:
+        gamma = _compute_gamma(px, py, pz)
+    mean_ene = np.average(gamma, weights=w)
     mean_z = np.average(z, weights=w)
-    dE_rel = (ene-mean_ene) / mean_ene
+    dE_rel = (gamma-mean_ene) / mean_ene
     dz = z - mean_z
-    p = np.polyfit(dz, dE_rel, 1)
-    K = p[0]
+    K = slope_of_correlation(dE_rel, dz, w)
     return K
 
 
-def rms_relative_correlated_energy_spread(z, px, py, pz, w=None):
+def rms_relative_correlated_energy_spread(z, px, py, pz, w=None,
+                                          gamma=None):
     """Calculate the correlated energy spread of the provided particle
     distribution
 
@@ -419,12 +813,19 @@ def rms_relative_correlated_energy_spread(z, px, py, pz, w=None):
     w : array or single value
         Statistical weight of the particles.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the energy spread value in non-dimmensional units,
     i.e. [1/(m_e c**2)]
     """
-    K = longitudinal_energy_chirp(z, px, py, pz, w)
+    z, px, py, pz, gamma = (_as_contig(a) for a in (z, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w, gamma)
+    K = longitudinal_energy_chirp(z, px, py, pz, w, gamma=gamma)
     mean_z = np.average(z, weights=w)
     dz = z - mean_z
     corr_ene = K*dz
@@ -461,14 +862,16 @@ def rms_relative_uncorrelated_energy_spread(z, px, py, pz, w=None):
     A float with the energy spread value in non-dimmensional units,
     i.e. [1/(m_e c**2)]
     """
+    z, px, py, pz = (_as_contig(a) for a in (z, px, py, pz))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w)
     if len(z) > 1:
-        ene = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+        ene = _compute_gamma(px, py, pz)
         mean_ene = np.average(ene, weights=w)
         mean_z = np.average(z, weights=w)
         dE = ene-mean_ene
         dz = z - mean_z
-        p = np.polyfit(dz, dE, 1)
-        K = p[0]
+        K = slope_of_correlation(dE, dz, w)
         unc_ene = ene - K*dz
         unc_ene_sp = weighted_std(unc_ene, w)/mean_ene
     else:
@@ -477,7 +880,8 @@ def rms_relative_uncorrelated_energy_spread(z, px, py, pz, w=None):
 
 
 def normalized_transverse_rms_emittance(x, px, py=None, pz=None, w=None,
-                                        disp_corrected=False, corr_order=1):
+                                        disp_corrected=False, corr_order=1,
+                                        gamma=None):
     """Calculate the normalized transverse RMS emittance without dispersion
     contributions of the particle distribution in a given plane.
 
@@ -509,26 +913,34 @@ def normalized_transverse_rms_emittance(x, px, py=None, pz=None, w=None,
     corr_order : int
         Highest order up to which dispersion effects should be corrected.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the emmitance value in units of m * rad
     """
+    x, px, py, pz, gamma = (_as_contig(a) for a in (x, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(x, px, py, pz, w, gamma)
     if len(x) > 1:
         if disp_corrected:
             # remove x-gamma correlation
-            gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+            if gamma is None:
+                gamma = _compute_gamma(px, py, pz)
             gamma_avg = np.average(gamma, weights=w)
             dgamma = (gamma - gamma_avg)/gamma_avg
             x = remove_correlation(dgamma, x, w, corr_order)
-        cov_x = np.cov(x, px, aweights=np.abs(w))
-        em_x = np.sqrt(np.linalg.det(cov_x.astype(np.float32, copy=False)))
+        em_x = _weighted_emittance_2d(x, px, w)
     else:
         em_x = 0
     return em_x
 
 
 def geometric_transverse_rms_emittance(x, px, py, pz, w=None,
-                                       disp_corrected=False, corr_order=1):
+                                       disp_corrected=False, corr_order=1,
+                                       gamma=None):
     """Calculate the geometric transverse RMS emittance without dispersion
     contributions of the particle distribution in a given plane.
 
@@ -552,20 +964,29 @@ def geometric_transverse_rms_emittance(x, px, py, pz, w=None,
         Whether ot not to correct for dispersion contributions.
     corr_order : int
         Highest order up to which dispersion effects should be corrected.
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
 
     Returns
     -------
     A float with the emmitance value in units of m * rad
     """
-    gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+    x, px, py, pz, gamma = (_as_contig(a) for a in (x, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(x, px, py, pz, w, gamma)
+    if gamma is None:
+        gamma = _compute_gamma(px, py, pz)
     gamma_avg = np.average(gamma, weights=w)
     em_x = normalized_transverse_rms_emittance(x, px, py, pz, w,
-                                               disp_corrected, corr_order)
+                                               disp_corrected, corr_order,
+                                               gamma=gamma)
     return em_x / gamma_avg
 
 
 def normalized_transverse_trace_space_rms_emittance(
-        x, px, py, pz, w=None, disp_corrected=False, corr_order=1):
+        x, px, py, pz, w=None, disp_corrected=False, corr_order=1,
+        gamma=None):
     """Calculate the normalized trasnverse trace-space RMS emittance of the
     particle distribution in a given plane.
 
@@ -596,19 +1017,29 @@ def normalized_transverse_trace_space_rms_emittance(
     corr_order : int
         Highest order up to which dispersion effects should be corrected.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the emmitance value in units of m * rad
     """
-    gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+    x, px, py, pz, gamma = (_as_contig(a) for a in (x, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(x, px, py, pz, w, gamma)
+    if gamma is None:
+        gamma = _compute_gamma(px, py, pz)
     gamma_avg = np.average(gamma, weights=w)
     em_x = transverse_trace_space_rms_emittance(x, px, py, pz, w,
-                                                disp_corrected, corr_order)
+                                                disp_corrected, corr_order,
+                                                gamma=gamma)
     return em_x * gamma_avg
 
 
 def transverse_trace_space_rms_emittance(x, px, py=None, pz=None, w=None,
-                                         disp_corrected=False, corr_order=1):
+                                         disp_corrected=False, corr_order=1,
+                                         gamma=None):
     """Calculate the trasnverse trace-space RMS emittance of the
     particle distribution in a given plane.
 
@@ -640,22 +1071,33 @@ def transverse_trace_space_rms_emittance(x, px, py=None, pz=None, w=None,
     corr_order : int
         Highest order up to which dispersion effects should be corrected.
 
+    gamma : array
+        Contains the Lorentz factor of the particles. If None, it is
+        calculated from px, py and pz.
+
     Returns
     -------
     A float with the emmitance value in units of m * rad
     """
+    x, px, py, pz, gamma = (_as_contig(a) for a in (x, px, py, pz, gamma))
+    w = _as_weights(w)
+    _check_lengths(x, px, py, pz, w, gamma)
     if len(x) > 1:
-        xp = px/pz
         if disp_corrected:
+            xp = px/pz
             # remove x-gamma correlation
-            gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+            if gamma is None:
+                gamma = _compute_gamma(px, py, pz)
             gamma_avg = np.average(gamma, weights=w)
             dgamma = (gamma - gamma_avg)/gamma_avg
             x = remove_correlation(dgamma, x, w, corr_order)
             # remove xp-gamma correlation
             xp = remove_correlation(dgamma, xp, w, corr_order)
-        cov_x = np.cov(x, xp, aweights=np.abs(w))
-        em_x = np.sqrt(np.linalg.det(cov_x.astype(np.float32, copy=False)))
+            em_x = _weighted_emittance_2d(x, xp, w)
+        else:
+            # xp = px/pz is evaluated on the fly
+            em_x = _emittance_from_moments(*_trace_space_moments(
+                x, px, pz, w))
     else:
         em_x = 0
     return em_x
@@ -689,9 +1131,11 @@ def longitudinal_rms_emittance(z, px, py, pz, w=None):
     -------
     A float with the emmitance value in units of m
     """
-    g = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-    cov_l = np.cov(z, g, aweights=np.abs(w))
-    em_l = np.sqrt(np.linalg.det(cov_l.astype(np.float32, copy=False)))
+    z, px, py, pz = (_as_contig(a) for a in (z, px, py, pz))
+    w = _as_weights(w)
+    _check_lengths(z, px, py, pz, w)
+    g = _compute_gamma(px, py, pz)
+    em_l = _weighted_emittance_2d(z, g, w)
     return em_l
 
 
@@ -717,6 +1161,8 @@ def peak_current(z, q, n_slices=10, len_slice=None):
     -------
     The absolute value of the peak current in Ampere.
     """
+    z, q = (_as_contig(a) for a in (z, q))
+    _check_lengths(z, q)
     current_prof, *_ = current_profile(z, q, n_slices=n_slices,
                                        len_slice=len_slice)
     current_prof = abs(current_prof)
@@ -745,6 +1191,8 @@ def fwhm_length(z, q, n_slices=10, len_slice=0.1e-6):
     -------
     The FWHM value in metres.
     """
+    z, q = (_as_contig(a) for a in (z, q))
+    _check_lengths(z, q)
     current_prof, z_edges = current_profile(z, q, n_slices=n_slices,
                                             len_slice=len_slice)
     slice_pos = z_edges[1:] - abs(z_edges[1]-z_edges[0])/2
@@ -796,24 +1244,23 @@ def relative_rms_slice_energy_spread(z, px, py, pz, w=None, n_slices=10,
     - An array with the slice edges.
     - A float with the weigthed average of the slice values.
     """
+    z, px, py, pz = (_as_contig(a) for a in (z, px, py, pz))
+    _check_lengths(z, px, py, pz, w)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
+    slice_idx, in_slices = _slice_indices(z, slice_lims)
+    w = _slice_weights(w, in_slices)
+    ene = _compute_gamma(px[in_slices], py[in_slices], pz[in_slices])
+    # Accumulate the weighted moments of each slice at once. The energy
+    # spread is taken relative to the mean energy of each slice to avoid
+    # cancellation errors.
+    slice_weight = _slice_sums(slice_idx, n_slices, w)
+    ene_mean = _slice_means(slice_idx, n_slices, w, slice_weight, ene)
+    d_ene = ene - ene_mean[slice_idx]
     slice_ene_sp = np.zeros(n_slices)
-    slice_weight = np.zeros(n_slices)
-    for i in np.arange(0, n_slices):
-        a = slice_lims[i]
-        b = slice_lims[i+1]
-        slice_particle_filter = (z > a) & (z <= b)
-        if slice_particle_filter.any():
-            px_slice = px[slice_particle_filter]
-            py_slice = py[slice_particle_filter]
-            pz_slice = pz[slice_particle_filter]
-            if hasattr(w, '__iter__'):
-                w_slice = w[slice_particle_filter]
-            else:
-                w_slice = w
-            slice_ene_sp[i] = relative_rms_energy_spread(px_slice, py_slice,
-                                                         pz_slice, w_slice)
-            slice_weight[i] = np.sum(w_slice)
+    filled = slice_weight > 0
+    ene_var = (_slice_sums(slice_idx, n_slices, w, d_ene**2)[filled]
+               / slice_weight[filled])
+    slice_ene_sp[filled] = np.sqrt(ene_var) / ene_mean[filled]
     slice_avg = calculate_slice_average(slice_ene_sp, slice_weight)
     return slice_ene_sp, slice_weight, slice_lims, slice_avg
 
@@ -858,25 +1305,28 @@ def rms_relative_uncorrelated_slice_energy_spread(z, px, py, pz, w=None,
     - An array with the slice edges.
     - A float with the weigthed average of the slice values.
     """
+    z, px, py, pz = (_as_contig(a) for a in (z, px, py, pz))
+    w = _slice_weights(w)
+    _check_lengths(z, px, py, pz, w)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
+    # sort the particles so that each slice is a contiguous range
+    slice_edges, (z, px, py, pz, w) = _sorted_slices(z, slice_lims,
+                                                     z, px, py, pz, w)
     slice_ene_sp = np.zeros(n_slices)
     slice_weight = np.zeros(n_slices)
     for i in np.arange(0, n_slices):
-        a = slice_lims[i]
-        b = slice_lims[i+1]
-        slice_particle_filter = (z > a) & (z <= b)
-        if slice_particle_filter.any():
-            z_slice = z[slice_particle_filter]
-            px_slice = px[slice_particle_filter]
-            py_slice = py[slice_particle_filter]
-            pz_slice = pz[slice_particle_filter]
-            if hasattr(w, '__iter__'):
-                w_slice = w[slice_particle_filter]
+        a = slice_edges[i]
+        b = slice_edges[i+1]
+        if b > a:
+            if np.ndim(w) > 0:
+                w_slice = w[a:b]
+                slice_weight[i] = np.sum(w_slice)
             else:
-                w_slice = w
+                # a single-valued weight only affects the slice weight
+                w_slice = None
+                slice_weight[i] = (b - a) * (1 if w is None else w)
             slice_ene_sp[i] = rms_relative_uncorrelated_energy_spread(
-                z_slice, px_slice, py_slice, pz_slice, w_slice)
-            slice_weight[i] = np.sum(w_slice)
+                z[a:b], px[a:b], py[a:b], pz[a:b], w_slice)
     slice_avg = calculate_slice_average(slice_ene_sp, slice_weight)
     return slice_ene_sp, slice_weight, slice_lims, slice_avg
 
@@ -933,37 +1383,43 @@ def normalized_transverse_rms_slice_emittance(
     - An array with the slice edges.
     - A float with the weigthed average of the slice values.
     """
+    z, x, px, py, pz = (_as_contig(a) for a in (z, x, px, py, pz))
+    _check_lengths(z, x, px, py, pz, w)
     if disp_corrected:
         # remove x-gamma correlation
-        gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-        gamma_avg = np.average(gamma, weights=w)
+        gamma = _compute_gamma(px, py, pz)
+        w_avg = _as_weights(w)
+        gamma_avg = np.average(gamma, weights=w_avg)
         dgamma = (gamma - gamma_avg)/gamma_avg
-        x = remove_correlation(dgamma, x, w, corr_order)
+        x = remove_correlation(dgamma, x, w_avg, corr_order)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
+    slice_idx, in_slices = _slice_indices(z, slice_lims)
+    w = _slice_weights(w, in_slices)
+    # Accumulate the weighted moments of each slice at once. The coordinates
+    # are taken relative to the centroid of each slice to avoid cancellation
+    # errors.
+    x = x[in_slices]
+    px = px[in_slices]
+    n_part = np.bincount(slice_idx, minlength=n_slices)
+    slice_weight = _slice_sums(slice_idx, n_slices, w)
+    dx = x - _slice_means(slice_idx, n_slices, w, slice_weight, x)[slice_idx]
+    dpx = (px - _slice_means(slice_idx, n_slices, w, slice_weight,
+                             px)[slice_idx])
+    sxx = _slice_sums(slice_idx, n_slices, w, dx*dx)
+    spxpx = _slice_sums(slice_idx, n_slices, w, dpx*dpx)
+    sxpx = _slice_sums(slice_idx, n_slices, w, dx*dpx)
     slice_em = np.zeros(n_slices)
-    slice_weight = np.zeros(n_slices)
-    for i in np.arange(0, n_slices):
-        a = slice_lims[i]
-        b = slice_lims[i+1]
-        slice_particle_filter = (z > a) & (z <= b)
-        if slice_particle_filter.any():
-            x_slice = x[slice_particle_filter]
-            px_slice = px[slice_particle_filter]
-            # if py is not None:
-            #    py_slice = py[slice_particle_filter]
-            # else:
-            #    py_slice=None
-            # if pz is not None:
-            #    pz_slice = pz[slice_particle_filter]
-            # else:
-            #    pz_slice=None
-            if hasattr(w, '__iter__'):
-                w_slice = w[slice_particle_filter]
-            else:
-                w_slice = w
-            slice_em[i] = normalized_transverse_rms_emittance(
-                x_slice, px_slice, w=w_slice)
-            slice_weight[i] = np.sum(w_slice)
+    filled = n_part > 1
+    sw = slice_weight[filled]
+    cov_xx = sxx[filled] / sw
+    cov_pxpx = spxpx[filled] / sw
+    cov_xpx = sxpx[filled] / sw
+    # Same unbiased normalization as np.cov with aweights.
+    cov_norm = sw**2 / (sw**2 - _slice_sums(slice_idx, n_slices, w**2)[filled])
+    # clamp determinants which round to slightly negative values (e.g. in
+    # slices with two particles), as done for the emittance of the full beam
+    slice_em[filled] = np.sqrt(
+        np.maximum(cov_xx*cov_pxpx - cov_xpx**2, 0)) * cov_norm
     slice_avg = calculate_slice_average(slice_em, slice_weight)
     return slice_em, slice_weight, slice_lims, slice_avg
 
@@ -1020,40 +1476,39 @@ def slice_twiss_parameters(
     - An array with the slice edges.
     - A list with the weighted average slice values of alpha, beta and gamma.
     """
+    z, x, px, pz, py = (_as_contig(a) for a in (z, x, px, pz, py))
+    w = _slice_weights(w)
+    _check_lengths(z, x, px, pz, py, w)
     if disp_corrected:
         # remove x-gamma correlation
-        gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-        gamma_avg = np.average(gamma, weights=w)
+        gamma = _compute_gamma(px, py, pz)
+        w_avg = _as_weights(w)
+        gamma_avg = np.average(gamma, weights=w_avg)
         dgamma = (gamma - gamma_avg)/gamma_avg
-        x = remove_correlation(dgamma, x, w, corr_order)
+        x = remove_correlation(dgamma, x, w_avg, corr_order)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
+    # sort the particles so that each slice is a contiguous range
+    slice_edges, (x, px, pz, w) = _sorted_slices(z, slice_lims, x, px, pz, w)
     slice_alpha = np.zeros(n_slices)
     slice_beta = np.zeros(n_slices)
     slice_gamma = np.zeros(n_slices)
     slice_weight = np.zeros(n_slices)
     for i in np.arange(0, n_slices):
-        a = slice_lims[i]
-        b = slice_lims[i+1]
-        slice_particle_filter = (z > a) & (z <= b)
-        if slice_particle_filter.any():
-            x_slice = x[slice_particle_filter]
-            px_slice = px[slice_particle_filter]
-            pz_slice = pz[slice_particle_filter]
-            # if py is not None:
-            #    py_slice = py[slice_particle_filter]
-            # else:
-            #    py_slice=None
-            # if pz is not None:
-            #    pz_slice = pz[slice_particle_filter]
-            # else:
-            #    pz_slice=None
-            if hasattr(w, '__iter__'):
-                w_slice = w[slice_particle_filter]
+        a = slice_edges[i]
+        b = slice_edges[i+1]
+        if b > a:
+            x_slice = x[a:b]
+            px_slice = px[a:b]
+            pz_slice = pz[a:b]
+            if np.ndim(w) > 0:
+                w_slice = w[a:b]
+                slice_weight[i] = np.sum(w_slice)
             else:
-                w_slice = w
+                # a single-valued weight only affects the slice weight
+                w_slice = None
+                slice_weight[i] = (b - a) * (1 if w is None else w)
             slice_alpha[i], slice_beta[i], slice_gamma[i] = twiss_parameters(
                 x_slice, px_slice, pz_slice, w=w_slice)
-            slice_weight[i] = np.sum(w_slice)
     slice_twiss_params = [slice_alpha, slice_beta, slice_gamma]
     alpha_avg = calculate_slice_average(slice_alpha, slice_weight)
     beta_avg = calculate_slice_average(slice_beta, slice_weight)
@@ -1099,23 +1554,19 @@ def energy_profile(z, px, py, pz, w=None, n_slices=10, len_slice=None):
     - An array with the statistical weight of each slice.
     - An array with the slice edges.
     """
+    z, px, py, pz = (_as_contig(a) for a in (z, px, py, pz))
+    _check_lengths(z, px, py, pz, w)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
+    # determine the slice of each particle once instead of masking z for
+    # every slice
+    slice_idx, in_slices = _slice_indices(z, slice_lims)
+    w = _slice_weights(w, in_slices)
+    ene = _compute_gamma(px[in_slices], py[in_slices], pz[in_slices])
+    slice_weight = _slice_sums(slice_idx, n_slices, w)
     slice_ene = np.zeros(n_slices)
-    slice_weight = np.zeros(n_slices)
-    for i in np.arange(0, n_slices):
-        a = slice_lims[i]
-        b = slice_lims[i+1]
-        slice_particle_filter = (z > a) & (z <= b)
-        if slice_particle_filter.any():
-            px_slice = px[slice_particle_filter]
-            py_slice = py[slice_particle_filter]
-            pz_slice = pz[slice_particle_filter]
-            if hasattr(w, '__iter__'):
-                w_slice = w[slice_particle_filter]
-            else:
-                w_slice = w
-            slice_ene[i] = mean_energy(px_slice, py_slice, pz_slice, w_slice)
-            slice_weight[i] = np.sum(w_slice)
+    filled = slice_weight != 0
+    slice_ene[filled] = (_slice_sums(slice_idx, n_slices, w, ene)[filled]
+                         / slice_weight[filled])
     return slice_ene, slice_weight, slice_lims
 
 
@@ -1143,9 +1594,13 @@ def current_profile(z, q, n_slices=10, len_slice=None):
     - An array with the current of each slice in units of A.
     - An array with the slice edges along z.
     """
+    z, q = (_as_contig(a) for a in (z, q))
+    _check_lengths(z, q)
     slice_lims, n_slices = create_beam_slices(z, n_slices, len_slice)
     sl_len = slice_lims[1] - slice_lims[0]
-    charge_hist, z_edges = np.histogram(z, bins=n_slices, weights=q)
+    # pass the known range to avoid another min/max scan of z
+    charge_hist, z_edges = np.histogram(
+        z, bins=n_slices, range=(slice_lims[0], slice_lims[-1]), weights=q)
     sl_dur = sl_len/ct.c
     current_prof = charge_hist/sl_dur
     return current_prof, z_edges
@@ -1181,11 +1636,13 @@ def energy_spectrum(px, py, pz, w=None, bins=10):
     - An array with the energy histogram  (normalized to 1).
     - An array with the bin edges of the histogram.
     """
-    if w is not None:
-        w = np.abs(w)
-    gamma = np.sqrt(1 + px**2 + py**2 + pz**2)
+    # a single-valued weight has no effect on the normalized histogram
+    px, py, pz = (_as_contig(a) for a in (px, py, pz))
+    w = _as_weights(w)
+    _check_lengths(px, py, pz, w)
+    gamma = _compute_gamma(px, py, pz)
     ene_hist, bin_edges = np.histogram(gamma, bins=bins, weights=w)
-    ene_hist /= np.max(ene_hist)
+    ene_hist = ene_hist / np.max(ene_hist)
     return ene_hist, bin_edges
 
 
@@ -1234,11 +1691,14 @@ def general_analysis(x, y, z, px, py, pz, q, n_slices=10, len_slice=None,
     bunch length, divergence, energy and the total and slice emittance and
     energy spread.
     """
+    x, y, z, px, py, pz, q = (_as_contig(a) for a in (x, y, z, px, py, pz, q))
+    _check_lengths(x, y, z, px, py, pz, q)
     q_tot = np.sum(q)
     a_x, b_x, g_x = twiss_parameters(x, px, pz, py, w=q)
     a_y, b_y, g_y = twiss_parameters(y, py, pz, px, w=q)
-    ene = mean_energy(px, py, pz, w=q)
-    ene_sp = relative_rms_energy_spread(px, py, pz, w=q)
+    # mean energy and energy spread from a single pass over the particles
+    ene, ene_std = _weighted_energy_stats(px, py, pz, _as_weights(q))
+    ene_sp = ene_std/ene
     enespls, sl_w, sl_lim, ene_sp_sl = relative_rms_slice_energy_spread(
         z, px, py, pz, w=q, n_slices=n_slices, len_slice=len_slice)
     em_x = normalized_transverse_rms_emittance(x, px, py, pz, w=q)
@@ -1317,3 +1777,141 @@ def general_analysis(x, y, z, px, py, pz, q, n_slices=10, len_slice=None,
         print('-'*80)
 
     return params_dict
+
+
+class BeamSoA:
+    """Particle distribution stored as a structure of arrays.
+
+    Quantities derived from the particle data which are needed by several
+    diagnostics, such as the Lorentz factor, are computed only once and
+    cached, so that evaluating many beam parameters of the same distribution
+    does not repeatedly stream through the particle arrays.
+
+    Parameters
+    ----------
+    x : array
+        Contains the transverse position of the particles in the x
+        transverse plane in units of meter
+
+    y : array
+        Contains the transverse position of the particles in the y
+        transverse plane in units of meter
+
+    z : array
+        Contains the longitudinal position of the particles in units of meters
+
+    px : array
+        Contains the transverse momentum of the beam particles in the x
+        direction in non-dimmensional units (beta*gamma)
+
+    py : array
+        Contains the transverse momentum of the beam particles in the y
+        direction in non-dimmensional units (beta*gamma)
+
+    pz : array
+        Contains the longitudinal momentum of the beam particles in
+        non-dimmensional units (beta*gamma).
+
+    w : array or single value
+        Statistical weight of the particles.
+
+    dtype : data-type
+        Data type in which the particle arrays are stored. If None, arrays
+        of floating-point type keep their precision and any other input is
+        converted to np.float64. In all cases, the arrays are stored
+        contiguously in memory. Storing them in single precision
+        (np.float32) halves the memory traffic of the diagnostics for large
+        distributions. The moments computed by the Numba kernels are always
+        accumulated in double precision, so that derived quantities such as
+        the emittance or the relative energy spread keep a relative accuracy
+        of about 1e-6 or better.
+    """
+    def __init__(self, x, y, z, px, py, pz, w=None, dtype=None):
+        x, y, z, px, py, pz, w = (_as_contig(a, dtype)
+                                  for a in (x, y, z, px, py, pz, w))
+        _check_lengths(x, y, z, px, py, pz, w)
+        self.x = x
+        self.y = y
+        self.z = z
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.w = w
+        self._gamma = None
+
+    @property
+    def gamma(self):
+        """Lorentz factor of the particles."""
+        if self._gamma is None:
+            self._gamma = _compute_gamma(self.px, self.py, self.pz)
+        return self._gamma
+
+    def twiss_parameters(self, plane='x', emitt='tr', disp_corrected=False,
+                         corr_order=1):
+        """Calculate the alpha, beta [m] and gamma [m^-1] functions of the
+        beam in the given transverse plane ('x' or 'y'). See
+        `twiss_parameters` for details."""
+        u, pu, pv = self._transverse_plane(plane)
+        return twiss_parameters(u, pu, self.pz, pv, self.w, emitt,
+                                disp_corrected, corr_order,
+                                gamma=self._gamma_if_needed(
+                                    disp_corrected))
+
+    def normalized_transverse_rms_emittance(self, plane='x',
+                                            disp_corrected=False,
+                                            corr_order=1):
+        """Calculate the normalized transverse RMS emittance in the given
+        transverse plane ('x' or 'y') in units of m * rad."""
+        u, pu, pv = self._transverse_plane(plane)
+        return normalized_transverse_rms_emittance(
+            u, pu, pv, self.pz, self.w, disp_corrected, corr_order,
+            gamma=self._gamma_if_needed(disp_corrected))
+
+    def geometric_transverse_rms_emittance(self, plane='x',
+                                           disp_corrected=False,
+                                           corr_order=1):
+        """Calculate the geometric transverse RMS emittance in the given
+        transverse plane ('x' or 'y') in units of m * rad."""
+        u, pu, pv = self._transverse_plane(plane)
+        return geometric_transverse_rms_emittance(
+            u, pu, pv, self.pz, self.w, disp_corrected, corr_order,
+            gamma=self.gamma)
+
+    def mean_energy(self):
+        """Calculate the mean energy in non-dimmensional units."""
+        return mean_energy(self.px, self.py, self.pz, self.w,
+                           gamma=self._gamma)
+
+    def rms_energy_spread(self):
+        """Calculate the absolute RMS energy spread in non-dimmensional
+        units."""
+        return rms_energy_spread(self.px, self.py, self.pz, self.w,
+                                 gamma=self._gamma)
+
+    def relative_rms_energy_spread(self):
+        """Calculate the relative RMS energy spread."""
+        return relative_rms_energy_spread(self.px, self.py, self.pz, self.w,
+                                          gamma=self._gamma)
+
+    def longitudinal_energy_chirp(self):
+        """Calculate the longitudinal energy chirp in units of m^(-1)."""
+        return longitudinal_energy_chirp(self.z, self.px, self.py, self.pz,
+                                         self.w, gamma=self.gamma)
+
+    def _transverse_plane(self, plane):
+        """Return the position, momentum and opposite-plane momentum arrays
+        of the given transverse plane."""
+        if plane == 'x':
+            return self.x, self.px, self.py
+        elif plane == 'y':
+            return self.y, self.py, self.px
+        raise ValueError(
+            "Plane '{}' not recognized. Possible values are 'x' and "
+            "'y'.".format(plane))
+
+    def _gamma_if_needed(self, needed):
+        """Return the (cached) Lorentz factor only if it is needed by the
+        diagnostic or it has already been computed."""
+        if needed:
+            return self.gamma
+        return self._gamma
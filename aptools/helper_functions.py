@@ -33,6 +33,33 @@ def create_beam_slices(z, n_slices=10, len_slice=None):
     return slice_lims, n_slices
 
 
+def weighted_average_of_product(a, b, weights=None):
+    """Calculates the weighted average of the element-wise product of two
+    arrays without creating the product array.
+
+    Parameters
+    ----------
+    a: array
+        Contains the first factor
+
+    b: array
+        Contains the second factor
+
+    weights : array
+        Contains the weights of the values. If None or a single value, all
+        values are equally weighted.
+
+    Returns
+    -------
+    A float with the value of the weighted average of a*b. The sum is always
+    accumulated in double precision.
+    """
+    if np.ndim(weights) == 0:
+        return np.einsum('i,i->', a, b, dtype=np.float64) / len(a)
+    return (np.einsum('i,i,i->', weights, a, b, dtype=np.float64)
+            / np.sum(weights, dtype=np.float64))
+
+
 def weighted_std(values, weights=1):
     """Calculates the weighted standard deviation of the given values
 
@@ -48,8 +75,14 @@ def weighted_std(values, weights=1):
     -------
     A float with the value of the standard deviation
     """
-    mean_val = np.average(values, weights=np.abs(weights))
-    std = np.sqrt(np.average((values-mean_val)**2, weights=np.abs(weights)))
+    if np.ndim(weights) == 0:
+        # a single value (or None) means all values are equally weighted
+        weights = None
+    else:
+        weights = np.abs(weights)
+    mean_val = np.average(values, weights=weights)
+    diff = values - mean_val
+    std = np.sqrt(weighted_average_of_product(diff, diff, weights))
     return std
 
 
@@ -72,11 +105,11 @@ def slope_of_correlation(y, x, w=None):
     -------
     A float with the value of the slope
     """
-    a = np.average(y*x, weights=w)
-    b = np.average(y, weights=w)
-    c = np.average(x, weights=w)
-    d = np.average(x**2, weights=w)
-    return (a-b*c) / (d-c**2)
+    # Use centered values to avoid cancellation errors.
+    dx = x - np.average(x, weights=w)
+    dy = y - np.average(y, weights=w)
+    return (weighted_average_of_product(dx, dy, w)
+            / weighted_average_of_product(dx, dx, w))
 
 
 def remove_correlation(x, y, w=None, order=1):
@@ -102,9 +135,26 @@ def remove_correlation(x, y, w=None, order=1):
     -------
     An array containing the new values of y
     """
-    fit_coefs = np.polyfit(x, y, order, w=w)
-    for i, coef in enumerate(reversed(fit_coefs[:-1])):
-        y = y - coef * x**(i+1)
+    if order == 1:
+        return y - slope_of_correlation(y, x, w) * x
+    # Solve the normal equations of the weighted polynomial fit directly. x is
+    # normalized to improve the conditioning of the system.
+    x_scale = np.max(np.abs(x))
+    if x_scale == 0:
+        return y
+    u = x / x_scale
+    u_pow = np.ones_like(u)
+    u_moments = np.empty(2*order + 1)
+    uy_moments = np.empty(order + 1)
+    for k in range(2*order + 1):
+        u_moments[k] = np.average(u_pow, weights=w)
+        if k <= order:
+            uy_moments[k] = weighted_average_of_product(u_pow, y, w)
+        u_pow = u_pow * u
+    k = np.arange(order + 1)
+    fit_coefs = np.linalg.solve(u_moments[k[:, None] + k], uy_moments)
+    for i, coef in enumerate(fit_coefs[1:]):
+        y = y - coef * u**(i+1)
     return y
 
 
@@ -0,0 +1,179 @@
+"""Tests for the beam diagnostics"""
+
+import numpy as np
+import pytest
+
+from aptools.data_analysis.beam_diagnostics import (
+    BeamSoA, mean_energy, normalized_transverse_rms_emittance,
+    twiss_parameters, relative_rms_slice_energy_spread,
+    normalized_transverse_rms_slice_emittance)
+
+
+N_PART = 10000
+
+# Single-valued weights, macroparticle weights and (negative) electron charges
+WEIGHTS = [None, 2., np.random.default_rng(1).uniform(0.5, 1.5, N_PART),
+           -1e-15 * np.random.default_rng(2).uniform(0.5, 1.5, N_PART)]
+
+
+def create_test_particles(n_part=N_PART):
+    """Create a particle distribution with an energy chirp, dispersion and a
+    correlation between x and px"""
+    rng = np.random.default_rng(0)
+    z = 1e-6 * rng.normal(size=n_part)
+    pz = 1000. + 1e7 * z + rng.normal(size=n_part)
+    x = 1e-6 * rng.normal(size=n_part) + 1e-4 * (pz - 1000.) / 1000.
+    y = 1e-6 * rng.normal(size=n_part)
+    px = -0.5e6 * x + rng.normal(size=n_part)
+    py = rng.normal(size=n_part)
+    return x, y, z, px, py, pz
+
+
+def create_test_beam(w):
+    """Create a BeamSoA with the test particle distribution"""
+    return BeamSoA(*create_test_particles(), w=w)
+
+
+def reference_weights(w):
+    """Return the particle weights as an array for the reference formulas"""
+    if np.ndim(w) == 0:
+        return np.ones(N_PART)
+    return np.abs(w)
+
+
+def remove_linear_correlation(x, y, w):
+    """Remove the linear correlation of y with x using np.polyfit"""
+    return y - np.polyval(np.polyfit(x, y, 1, w=np.sqrt(w)), x)
+
+
+def reference_twiss(u, v, w, gamma_avg=1.):
+    """Calculate the alpha, beta and gamma functions from the covariance
+    matrix of u and v. As in twiss_parameters, the emittance is given by the
+    unbiased covariance matrix and the second moments are biased."""
+    em = np.sqrt(np.linalg.det(np.cov(u, v, aweights=w)))
+    cov = np.cov(u, v, aweights=w, bias=True)
+    alpha = -cov[0, 1] / em
+    beta = cov[0, 0] * gamma_avg / em
+    return np.array([alpha, beta, (1 + alpha**2) / beta])
+
+
+def evaluate_diagnostics(beam, gamma_first):
+    """Evaluate the beam diagnostics in an order in which the Lorentz factor
+    of the particles is either cached first or last"""
+    diags = [
+        beam.mean_energy,
+        beam.rms_energy_spread,
+        beam.relative_rms_energy_spread,
+        beam.normalized_transverse_rms_emittance,
+        beam.twiss_parameters,
+        lambda: beam.twiss_parameters(emitt='ph'),
+        lambda: beam.twiss_parameters(disp_corrected=True),
+        beam.geometric_transverse_rms_emittance,
+        beam.longitudinal_energy_chirp,
+    ]
+    if gamma_first:
+        diags = diags[::-1]
+    results = {i: np.ravel(f()) for i, f in enumerate(diags)}
+    if gamma_first:
+        results = {len(diags) - 1 - i: r for i, r in results.items()}
+    return [results[i] for i in range(len(diags))]
+
+
+def reference_diagnostics(w):
+    """Calculate the diagnostics of evaluate_diagnostics with reference
+    formulas"""
+    x, y, z, px, py, pz = create_test_particles()
+    w = reference_weights(w)
+    gamma = np.sqrt(1 + px**2 + py**2 + pz**2)
+    gamma_avg = np.average(gamma, weights=w)
+    ene_std = np.sqrt(np.average((gamma - gamma_avg)**2, weights=w))
+    em = np.sqrt(np.linalg.det(np.cov(x, px, aweights=w)))
+    dgamma = (gamma - gamma_avg) / gamma_avg
+    x_dc = remove_linear_correlation(dgamma, x, w)
+    xp_dc = remove_linear_correlation(dgamma, px / pz, w)
+    chirp = np.polyfit(z - np.average(z, weights=w), dgamma, 1,
+                       w=np.sqrt(w))[0]
+    return [
+        np.array([gamma_avg]),
+        np.array([ene_std]),
+        np.array([ene_std / gamma_avg]),
+        np.array([em]),
+        reference_twiss(x, px / pz, w),
+        reference_twiss(x, px, w, gamma_avg),
+        reference_twiss(x_dc, xp_dc, w),
+        np.array([em / gamma_avg]),
+        np.array([chirp]),
+    ]
+
+
+@pytest.mark.parametrize('w', WEIGHTS)
+def test_beam_soa_reference(w):
+    """Check the BeamSoA diagnostics against reference formulas"""
+    results = evaluate_diagnostics(create_test_beam(w), gamma_first=False)
+    for res, res_ref in zip(results, reference_diagnostics(w)):
+        np.testing.assert_allclose(res, res_ref, rtol=1e-8)
+
+
+@pytest.mark.parametrize('w', WEIGHTS)
+def test_beam_soa_cache_order(w):
+    """Check that the BeamSoA diagnostics do not depend on whether the
+    Lorentz factor has already been cached"""
+    results = evaluate_diagnostics(create_test_beam(w), gamma_first=False)
+    results_cached = evaluate_diagnostics(create_test_beam(w),
+                                          gamma_first=True)
+    for res, res_cached in zip(results, results_cached):
+        np.testing.assert_allclose(res, res_cached, rtol=1e-10)
+
+
+@pytest.mark.parametrize('n_w', [1, N_PART // 2])
+def test_mismatched_lengths(n_w):
+    """Check that particle arrays of different lengths raise an error
+    instead of being read out of bounds"""
+    x, y, z, px, py, pz = create_test_particles()
+    w = np.ones(n_w)
+    with pytest.raises(ValueError):
+        mean_energy(px, py, pz, w=w)
+    with pytest.raises(ValueError):
+        normalized_transverse_rms_emittance(x, px, py, pz, w=w)
+    with pytest.raises(ValueError):
+        twiss_parameters(x, px, pz, py, w=w)
+    with pytest.raises(ValueError):
+        BeamSoA(x, y, z, px, py, pz, w=w)
+
+
+@pytest.mark.parametrize('w', [None, WEIGHTS[3]])
+def test_slice_diagnostics_reference(w):
+    """Check the vectorized slice diagnostics against a loop over the
+    particles of each slice"""
+    x, y, z, px, py, pz = create_test_particles()
+    n_slices = 200
+    sl_ene_sp, sl_w, sl_lims, _ = relative_rms_slice_energy_spread(
+        z, px, py, pz, w=w, n_slices=n_slices)
+    sl_em, sl_w_em, _, _ = normalized_transverse_rms_slice_emittance(
+        z, x, px, py, pz, w=w, n_slices=n_slices)
+    w = reference_weights(w)
+    gamma = np.sqrt(1 + px**2 + py**2 + pz**2)
+    ene_sp_ref = np.zeros(n_slices)
+    em_ref = np.zeros(n_slices)
+    w_ref = np.zeros(n_slices)
+    for i in range(n_slices):
+        in_slice = (z > sl_lims[i]) & (z <= sl_lims[i+1])
+        n_in_slice = np.sum(in_slice)
+        w_ref[i] = np.sum(w[in_slice])
+        if n_in_slice > 0:
+            ene_avg = np.average(gamma[in_slice], weights=w[in_slice])
+            ene_sp_ref[i] = np.sqrt(np.average(
+                (gamma[in_slice] - ene_avg)**2,
+                weights=w[in_slice])) / ene_avg
+        if n_in_slice > 1:
+            cov = np.cov(x[in_slice], px[in_slice], aweights=w[in_slice])
+            em_ref[i] = np.sqrt(max(np.linalg.det(cov), 0))
+    # the slices at the edges of the beam contain only a few particles
+    assert np.any((np.bincount(np.digitize(z, sl_lims, right=True),
+                               minlength=n_slices + 2)[1:-1] == 2))
+    np.testing.assert_allclose(sl_w, w_ref, rtol=1e-12)
+    np.testing.assert_allclose(sl_w_em, w_ref, rtol=1e-12)
+    np.testing.assert_allclose(sl_ene_sp, ene_sp_ref, rtol=1e-8,
+                               atol=1e-8 * np.max(ene_sp_ref))
+    np.testing.assert_allclose(sl_em, em_ref, rtol=1e-6,
+                               atol=1e-6 * np.max(em_ref))
@@ -0,0 +1,26 @@
+"""Tests for the helper functions"""
+
+import numpy as np
+import pytest
+
+from aptools.helper_functions import remove_correlation
+
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_remove_correlation(order, weighted):
+    """Check remove_correlation against a polynomial fit with np.polyfit"""
+    rng = np.random.default_rng(0)
+    n_part = 10000
+    x = 1e-2 * rng.normal(size=n_part)
+    y = (1e-6 + 1e-4*x - 3e-2*x**2 + 5.*x**3
+         + 1e-7 * rng.normal(size=n_part))
+    w = rng.uniform(0.5, 1.5, n_part) if weighted else None
+    y_uncorr = remove_correlation(x, y, w, order)
+    # remove_correlation keeps the constant term of the fit
+    fit_coefs = np.polyfit(x, y, order,
+                           w=None if w is None else np.sqrt(w))
+    fit_coefs[-1] = 0
+    y_ref = y - np.polyval(fit_coefs, x)
+    np.testing.assert_allclose(y_uncorr, y_ref, rtol=0,
+                               atol=1e-10 * np.std(y))